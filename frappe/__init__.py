@@ -1642,8 +1642,26 @@ def get_desk_link(doctype, name):
 def bold(text):
 	return '<b>{0}</b>'.format(text)
 
+class _SafeEvalCode(object):
+	'''Expression validated and compiled by `compile_safe_eval`'''
+	__slots__ = ('code',)
+
+	def __init__(self, code):
+		self.code = code
+
+def _validate_safe_eval_code(code):
+	if '__' in code:
+		throw('Illegal rule {0}. Cannot use "__"'.format(bold(code)))
+
+def compile_safe_eval(code, filename='<safe_eval>'):
+	'''Validate and compile an expression once, to be evaluated repeatedly by `safe_eval`'''
+	_validate_safe_eval_code(code)
+	return _SafeEvalCode(compile(code, filename, 'eval'))
+
 def safe_eval(code, eval_globals=None, eval_locals=None):
-	'''A safer `eval`'''
+	'''A safer `eval`
+
+	:param code: Expression string, or the result of `compile_safe_eval`.'''
 	whitelisted_globals = {
 		"int": int,
 		"float": float,
@@ -1651,8 +1669,10 @@ def safe_eval(code, eval_globals=None, eval_locals=None):
 		"round": round
 	}
 
-	if '__' in code:
-		throw('Illegal rule {0}. Cannot use "__"'.format(bold(code)))
+	if isinstance(code, _SafeEvalCode):
+		code = code.code
+	else:
+		_validate_safe_eval_code(code)
 
 	if not eval_globals:
 		eval_globals = {}
@@ -65,6 +65,8 @@ class Database(object):
 
 		self.password = password or frappe.conf.db_password
 		self.value_cache = {}
+		# number of rollback observers registered when each savepoint was set
+		self.savepoint_observers = {}
 
 	def setup_type_map(self):
 		pass
@@ -752,6 +754,7 @@ class Database(object):
 		self.sql("commit")
 
 		frappe.local.rollback_observers = []
+		self.savepoint_observers = {}
 		self.flush_realtime_log()
 		enqueue_jobs_after_commit()
 		flush_local_link_count()
@@ -766,14 +769,34 @@ class Database(object):
 
 		frappe.local.realtime_log = []
 
-	def rollback(self):
-		"""`ROLLBACK` current transaction."""
+	def savepoint(self, save_point):
+		"""Set a `SAVEPOINT` the current transaction can be partially rolled back to."""
+		self.sql("savepoint {0}".format(save_point))
+		self.savepoint_observers[save_point] = len(frappe.local.rollback_observers)
+
+	def rollback(self, save_point=None):
+		"""`ROLLBACK` current transaction.
+
+		:param save_point: [optional] Only roll back changes made after this savepoint."""
+		if save_point:
+			self.sql("rollback to savepoint {0}".format(save_point))
+
+			# notify only the observers registered after the savepoint
+			observers = frappe.local.rollback_observers
+			start = self.savepoint_observers.get(save_point, len(observers))
+			for obj in observers[start:]:
+				if hasattr(obj, "on_rollback"):
+					obj.on_rollback()
+			del observers[start:]
+			return
+
 		self.sql("rollback")
 		self.begin()
 		for obj in frappe.local.rollback_observers:
 			if hasattr(obj, "on_rollback"):
 				obj.on_rollback()
 		frappe.local.rollback_observers = []
+		self.savepoint_observers = {}
 
 	def field_exists(self, dt, fn):
 		"""Return true of field exists."""
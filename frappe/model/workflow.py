@@ -3,15 +3,26 @@
 
 from __future__ import unicode_literals
 import frappe
-from frappe.utils import cint
+from frappe.utils import cint, get_datetime
 from frappe import _
+from frappe.model.base_document import BaseDocument
 from six import string_types
-import json
+from functools import lru_cache
+from collections import defaultdict
+
+try:
+	# faster drop-in for parsing large docname lists, when available
+	from orjson import loads as json_loads
+except ImportError:
+	from json import loads as json_loads
 
 class WorkflowStateError(frappe.ValidationError): pass
 class WorkflowTransitionError(frappe.ValidationError): pass
 class WorkflowPermissionError(frappe.ValidationError): pass
 
+# number of documents applied between commits in bulk_workflow_approval
+BULK_APPROVAL_COMMIT_SIZE = 50
+
 def get_workflow_name(doctype):
 	workflow_name = frappe.cache().hget('workflow', doctype)
 	if workflow_name is None:
@@ -24,18 +35,30 @@ def get_workflow_name(doctype):
 @frappe.whitelist()
 def get_transitions(doc, workflow = None, raise_exception=False):
 	'''Return list of possible transitions for the given doc'''
-	doc = frappe.get_doc(frappe.parse_json(doc))
+	doc = load_doc(doc)
+	return _get_transitions(doc, workflow, raise_exception)
+
+def load_doc(doc):
+	'''Return the doc with its values loaded from the database, transitions are never computed on client values'''
+	if not isinstance(doc, BaseDocument):
+		doc = frappe.get_doc(frappe.parse_json(doc))
 
+	if not doc.is_new():
+		doc.load_from_db()
+
+	return doc
+
+def _get_transitions(doc, workflow=None, raise_exception=False):
+	'''Return list of possible transitions for a doc already loaded with `load_doc`'''
 	if doc.is_new():
 		return []
 
-	doc.load_from_db()
-
 	frappe.has_permission(doc, 'read', throw=True)
 	roles = frappe.get_roles()
 
 	if not workflow:
 		workflow = get_workflow(doc.doctype)
+	index_workflow(workflow)
 	current_state = doc.get(workflow.workflow_state_field)
 
 	if not current_state:
@@ -45,8 +68,8 @@ def get_transitions(doc, workflow = None, raise_exception=False):
 			frappe.throw(_('Workflow State not set'), WorkflowStateError)
 
 	transitions = []
-	for transition in workflow.transitions:
-		if transition.state == current_state and transition.allowed in roles:
+	for transition in workflow._by_state.get(current_state, ()):
+		if transition.allowed in roles:
 			if not is_transition_condition_satisfied(transition, doc):
 				continue
 			transitions.append(transition.as_dict())
@@ -67,25 +90,31 @@ def get_workflow_safe_globals():
 		)
 	)
 
+@lru_cache(maxsize=1024)
+def compile_condition(condition):
+	'''Validate and compile a transition condition once, conditions are evaluated for every transition check'''
+	return frappe.compile_safe_eval(condition, '<workflow condition>')
+
 def is_transition_condition_satisfied(transition, doc):
 	if not transition.condition:
 		return True
 	else:
-		return frappe.safe_eval(transition.condition, get_workflow_safe_globals(), dict(doc=doc.as_dict()))
+		return frappe.safe_eval(compile_condition(transition.condition), get_workflow_safe_globals(), dict(doc=doc.as_dict()))
 
 @frappe.whitelist()
 def apply_workflow(doc, action):
 	'''Allow workflow action on the current doc'''
-	doc = frappe.get_doc(frappe.parse_json(doc))
-	workflow = get_workflow(doc.doctype)
-	transitions = get_transitions(doc, workflow)
+	return _apply_workflow(load_doc(doc), action)
+
+def _apply_workflow(doc, action, workflow=None):
+	'''Apply `action` on a doc already loaded with `load_doc`, optionally with a preloaded workflow'''
+	if not workflow:
+		workflow = get_workflow(doc.doctype)
+	transitions = _get_transitions(doc, workflow)
 	user = frappe.session.user
 
-	# find the transition
-	transition = None
-	for t in transitions:
-		if t.action == action:
-			transition = t
+	# find the transition, the last matching row wins
+	transition = next((t for t in reversed(transitions) if t.action == action), None)
 
 	if not transition:
 		frappe.throw(_("Not a valid Workflow Action"), WorkflowTransitionError)
@@ -97,7 +126,7 @@ def apply_workflow(doc, action):
 	doc.set(workflow.workflow_state_field, transition.next_state)
 
 	# find settings for the next state
-	next_state = [d for d in workflow.states if d.state == transition.next_state][0]
+	next_state = workflow._states_by_name[transition.next_state]
 
 	# update any additional field
 	if next_state.update_field:
@@ -124,10 +153,7 @@ def can_cancel_document(doctype):
 	workflow = get_workflow(doctype)
 	for state_doc in workflow.states:
 		if state_doc.doc_status == '2':
-			for transition in workflow.transitions:
-				if transition.next_state == state_doc.state:
-					return False
-			return True
+			return state_doc.state not in workflow._by_next_state
 	return True
 
 def validate_workflow(doc):
@@ -150,10 +176,8 @@ def validate_workflow(doc):
 	if not current_state:
 		current_state = workflow.states[0].state
 
-	state_row = [d for d in workflow.states if d.state == current_state]
-	if not state_row:
+	if current_state not in workflow._states_by_name:
 		frappe.throw(_('{0} is not a valid Workflow State. Please update your Workflow and try again.').format(frappe.bold(current_state)))
-	state_row = state_row[0]
 
 	# if transitioning, check if user is allowed to transition
 	if current_state != next_state:
@@ -173,7 +197,33 @@ def validate_workflow(doc):
 				WorkflowPermissionError)
 
 def get_workflow(doctype):
-	return frappe.get_doc('Workflow', get_workflow_name(doctype))
+	return get_cached_workflow(get_workflow_name(doctype))
+
+def get_cached_workflow(workflow_name):
+	# workflow definitions are read on every transition check, serve them from the document cache
+	return index_workflow(frappe.get_cached_doc('Workflow', workflow_name))
+
+def index_workflow(workflow):
+	'''Set state and transition lookups on the workflow, built once per loaded document'''
+	if getattr(workflow, '_by_state', None) is None:
+		by_state, by_next_state = defaultdict(list), defaultdict(list)
+		for transition in workflow.transitions:
+			by_state[transition.state].append(transition)
+			by_next_state[transition.next_state].append(transition)
+
+		workflow._by_state = dict(by_state)
+		workflow._by_next_state = dict(by_next_state)
+
+		# first matching row wins, as with the list scans these replace
+		workflow._states_by_name, workflow._states_by_doc_status = {}, {}
+		for state in workflow.states:
+			workflow._states_by_name.setdefault(state.state, state)
+			workflow._states_by_doc_status.setdefault(state.doc_status, state)
+
+		# state names are not unique, keep every (state, docstatus) pair
+		workflow._state_doc_statuses = {(state.state, cint(state.doc_status)) for state in workflow.states}
+
+	return workflow
 
 def has_approval_access(user, doc, transition):
 	return (user == 'Administrator'
@@ -186,6 +236,12 @@ def get_workflow_state_field(workflow_name):
 def send_email_alert(workflow_name):
 	return get_workflow_field_value(workflow_name, 'send_email_alert')
 
+def get_workflow_document_state_value(workflow_name, state, fieldname):
+	'''Return `fieldname` of the Workflow Document State row for `state`, read from the cached workflow'''
+	workflow = get_cached_workflow(workflow_name)
+	state_row = workflow._states_by_name.get(state)
+	return state_row.get(fieldname) if state_row else None
+
 def get_workflow_field_value(workflow_name, field):
 	value = frappe.cache().hget('workflow_' + workflow_name, field)
 	if value is None:
@@ -195,8 +251,6 @@ def get_workflow_field_value(workflow_name, field):
 
 @frappe.whitelist()
 def bulk_workflow_approval(docnames, doctype, action):
-	from collections import defaultdict
-
 	# dictionaries for logging
 	failed_transactions = defaultdict(list)
 	successful_transactions = defaultdict(list)
@@ -205,13 +259,18 @@ def bulk_workflow_approval(docnames, doctype, action):
 	print("Clearing frappe.message_log...")
 	frappe.clear_messages()
 
-	docnames = json.loads(docnames)
+	docnames = json_loads(docnames)
+	workflow = get_workflow(doctype)
+	# modified timestamp set on each document applied since the last commit
+	uncommitted = {}
 	for (idx, docname) in enumerate(docnames, 1):
 		message_dict = {}
+		save_point = 'workflow_{0}'.format(idx)
 		try:
 			show_progress(docnames, _('Applying: {0}').format(action), idx, docname)
-			apply_workflow(frappe.get_doc(doctype, docname), action)
-			frappe.db.commit()
+			frappe.db.savepoint(save_point)
+			doc = _apply_workflow(load_doc(frappe.get_doc({'doctype': doctype, 'name': docname})), action, workflow)
+			uncommitted[docname] = doc.modified
 		except Exception as e:
 			if not frappe.message_log:
 				# Exception is  raised manually and not from msgprint or throw
@@ -221,7 +280,12 @@ def bulk_workflow_approval(docnames, doctype, action):
 				message_dict = {"docname": docname, "message": message}
 				failed_transactions[docname].append(message_dict)
 
-			frappe.db.rollback()
+			if not rollback_to_savepoint(save_point):
+				# the whole open transaction was rolled back, report the documents it took with it
+				report_rolled_back(doctype, uncommitted, successful_transactions, failed_transactions,
+					_("Rolled back after {0} failed, please apply the action again").format(docname))
+				uncommitted = {}
+
 			frappe.log_error(frappe.get_traceback(), "Workflow {0} threw an error for {1} {2}".format(action, doctype, docname))
 		finally:
 			if not message_dict:
@@ -238,6 +302,16 @@ def bulk_workflow_approval(docnames, doctype, action):
 				else:
 					successful_transactions[docname].append({"docname": docname, "message": None})
 
+		if idx % BULK_APPROVAL_COMMIT_SIZE == 0 or idx == len(docnames):
+			try:
+				frappe.db.commit()
+			except Exception:
+				frappe.db.rollback()
+				report_rolled_back(doctype, uncommitted, successful_transactions, failed_transactions,
+					_("Could not be committed, please apply the action again"))
+				frappe.log_error(frappe.get_traceback(), "Workflow {0} could not commit {1}".format(action, doctype))
+			uncommitted = {}
+
 	if failed_transactions and successful_transactions:
 		indicator = "orange"
 	elif failed_transactions:
@@ -248,37 +322,75 @@ def bulk_workflow_approval(docnames, doctype, action):
 	print_workflow_log(failed_transactions, _("Failed Transactions"), doctype, indicator)
 	print_workflow_log(successful_transactions, _("Successful Transactions"), doctype, indicator)
 
+def rollback_to_savepoint(save_point):
+	'''Undo the failed document only, keeping earlier uncommitted documents of the batch.
+
+	Returns False if the whole transaction had to be rolled back instead.'''
+	try:
+		frappe.db.rollback(save_point=save_point)
+		return True
+	except Exception:
+		# the savepoint is gone: postgres rolls back the transaction on any query error,
+		# mariadb on a deadlock, and an implicit commit releases it
+		frappe.db.rollback()
+		return False
+
+def report_rolled_back(doctype, uncommitted, successful_transactions, failed_transactions, message):
+	'''Move documents applied since the last commit that did not persist to the failed transactions'''
+	for name in get_rolled_back_docnames(doctype, uncommitted):
+		successful_transactions.pop(name, None)
+		failed_transactions[name].append({"docname": name, "message": message})
+
+def get_rolled_back_docnames(doctype, uncommitted):
+	'''Return documents applied since the last commit whose save is not in the database.
+
+	Compares `modified`, which every applied document changes, even on a transition to the same state.'''
+	if not uncommitted:
+		return []
+
+	saved = dict(frappe.get_all(doctype, filters={'name': ['in', list(uncommitted)]},
+		fields=['name', 'modified'], as_list=True))
+	return [name for name, modified in uncommitted.items()
+		if not saved.get(name) or get_datetime(saved[name]) != get_datetime(modified)]
+
 def print_workflow_log(messages, title, doctype, indicator):
-	if messages.keys():
-		msg = "<h4>{0}</h4>".format(title)
-
-		for doc in messages.keys():
-			if len(messages[doc]):
-				html = "<details><summary>{0}</summary>".format(frappe.utils.get_link_to_form(doctype, doc))
-				for log in messages[doc]:
-					if log.get('message'):
-						html += "<div class='small text-muted' style='padding:2.5px'>{0}</div>".format(log.get('message'))
-				html += "</details>"
+	if messages:
+		msg = ["<h4>{0}</h4>".format(title)]
+
+		for doc, logs in messages.items():
+			if logs:
+				msg.append("<details><summary>{0}</summary>".format(frappe.utils.get_link_to_form(doctype, doc)))
+				msg.extend("<div class='small text-muted' style='padding:2.5px'>{0}</div>".format(log.get('message'))
+					for log in logs if log.get('message'))
+				msg.append("</details>")
 			else:
-				html = "<div>{0}</div>".format(doc)
-			msg += html
+				msg.append("<div>{0}</div>".format(doc))
 
-		frappe.msgprint(msg, title=_("Workflow Status"), indicator=indicator, is_minimizable=True)
+		frappe.msgprint("".join(msg), title=_("Workflow Status"), indicator=indicator, is_minimizable=True)
 
 @frappe.whitelist()
 def get_common_transition_actions(docs, doctype):
 	common_actions = []
 	if isinstance(docs, string_types):
-		docs = json.loads(docs)
+		docs = json_loads(docs)
+	if not docs:
+		return []
+
+	workflow = get_workflow(doctype)
 	try:
 		for (i, doc) in enumerate(docs, 1):
 			if not doc.get('doctype'):
 				doc['doctype'] = doctype
-			actions = [t.get('action') for t in get_transitions(doc, raise_exception=True) \
+			actions = [t.get('action') for t in get_transitions(doc, workflow, raise_exception=True)
 				if has_approval_access(frappe.session.user, doc, t)]
 			if not actions:
 				return []
-			common_actions = actions if i == 1 else set(common_actions).intersection(actions)
+			# keep the transition order of the first document
+			if i == 1:
+				common_actions = list(dict.fromkeys(actions))
+			else:
+				actions = set(actions)
+				common_actions = [a for a in common_actions if a in actions]
 			if not common_actions:
 				return []
 	except WorkflowStateError:
@@ -288,7 +400,8 @@ def get_common_transition_actions(docs, doctype):
 
 def show_progress(docnames, message, i, description):
 	n = len(docnames)
-	if n >= 5:
+	# publish at most ~100 updates per batch, each one is a redis round trip
+	if n >= 5 and (i == n or i % max(1, n // 100) == 0):
 		frappe.publish_progress(
 			float(i) * 100 / n,
 			title = message,
@@ -296,21 +409,18 @@ def show_progress(docnames, message, i, description):
 		)
 
 def set_workflow_state_on_action(doc, workflow_name, action):
-	workflow = frappe.get_doc('Workflow', workflow_name)
+	workflow = get_cached_workflow(workflow_name)
 	workflow_state_field = workflow.workflow_state_field
 
 	# If workflow state of doc is already correct, don't set workflow state
-	for state in workflow.states:
-		if state.state == doc.get(workflow_state_field) and doc.docstatus == cint(state.doc_status):
-			return
+	if (doc.get(workflow_state_field), cint(doc.docstatus)) in workflow._state_doc_statuses:
+		return
 
 	action_map = {
 		'update_after_submit': '1',
 		'submit': '1',
 		'cancel': '2'
 	}
-	docstatus = action_map[action]
-	for state in workflow.states:
-		if state.doc_status == docstatus:
-			doc.set(workflow_state_field, state.state)
-			return
+	state = workflow._states_by_doc_status.get(action_map[action])
+	if state:
+		doc.set(workflow_state_field, state.state)
@@ -42,6 +42,32 @@ class TestDB(unittest.TestCase):
 		self.assertEqual(frappe.db.get_value('ToDo', todo1.name, 'description'), 'change 2')
 		self.assertEqual(frappe.db.get_value('ToDo', todo2.name, 'description'), 'change 2')
 
+	def test_savepoint(self):
+		todo1 = frappe.get_doc(dict(doctype='ToDo', description='test_savepoint 1')).insert()
+		frappe.db.savepoint('test_savepoint')
+		todo2 = frappe.get_doc(dict(doctype='ToDo', description='test_savepoint 2')).insert()
+
+		frappe.db.rollback(save_point='test_savepoint')
+		self.assertTrue(frappe.db.exists('ToDo', todo1.name))
+		self.assertFalse(frappe.db.exists('ToDo', todo2.name))
+
+	def test_savepoint_rollback_observers(self):
+		class Observer(object):
+			rolled_back = False
+
+			def on_rollback(self):
+				self.rolled_back = True
+
+		before, after = Observer(), Observer()
+		frappe.local.rollback_observers.append(before)
+		frappe.db.savepoint('test_savepoint_observers')
+		frappe.local.rollback_observers.append(after)
+
+		frappe.db.rollback(save_point='test_savepoint_observers')
+		self.assertFalse(before.rolled_back)
+		self.assertTrue(after.rolled_back)
+		self.assertEqual(frappe.local.rollback_observers, [before])
+		frappe.local.rollback_observers.remove(before)
 
 	def test_escape(self):
 		frappe.db.escape("香港濟生堂製藥有限公司 - IT".encode("utf-8"))
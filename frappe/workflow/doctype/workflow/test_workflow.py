@@ -3,9 +3,12 @@
 from __future__ import unicode_literals
 
 import frappe
+import json
 import unittest
+from unittest.mock import patch
 from frappe.utils import random_string
-from frappe.model.workflow import apply_workflow, WorkflowTransitionError, WorkflowPermissionError, get_common_transition_actions
+from frappe.model.workflow import apply_workflow, WorkflowTransitionError, WorkflowPermissionError, get_common_transition_actions, \
+	bulk_workflow_approval
 from frappe.test_runner import make_test_records
 
 
@@ -58,6 +61,16 @@ class TestWorkflow(unittest.TestCase):
 		self.workflow.transitions[0].condition = ''
 		self.workflow.save()
 
+	def test_illegal_workflow_condition(self):
+		'''Test dunder access in transition condition is rejected'''
+		self.workflow.transitions[0].condition = 'doc.__class__'
+		self.workflow.save()
+
+		self.assertRaisesRegex(frappe.ValidationError, 'Cannot use "__"', self.test_approve)
+
+		self.workflow.transitions[0].condition = ''
+		self.workflow.save()
+
 	def test_get_common_transition_actions(self):
 		todo1 = create_new_todo()
 		todo2 = create_new_todo()
@@ -77,6 +90,74 @@ class TestWorkflow(unittest.TestCase):
 		actions = get_common_transition_actions([todo1, todo2], 'ToDo')
 		self.assertListEqual(actions, ['Review'])
 
+	def test_bulk_workflow_approval(self):
+		'''Test a failing document does not undo the others in the batch'''
+		todo1, todo2, todo3 = create_new_todo(), create_new_todo(), create_new_todo()
+		# Approve is not a valid action for a rejected todo
+		apply_workflow(todo2, 'Reject')
+		frappe.db.commit()
+
+		bulk_workflow_approval(json.dumps([todo1.name, todo2.name, todo3.name]), 'ToDo', 'Approve')
+
+		self.assertEqual(get_workflow_state(todo1), 'Approved')
+		self.assertEqual(get_workflow_state(todo2), 'Rejected')
+		self.assertEqual(get_workflow_state(todo3), 'Approved')
+
+	def test_bulk_workflow_approval_after_transaction_rollback(self):
+		'''Test documents lost with a full rollback are reported as failed'''
+		todo1, todo2, todo3 = create_new_todo(), create_new_todo(), create_new_todo()
+		apply_workflow(todo2, 'Reject')
+		frappe.db.commit()
+
+		def full_rollback(save_point):
+			# as on postgres after a query error, or on a deadlock
+			frappe.db.rollback()
+			return False
+
+		with patch('frappe.model.workflow.rollback_to_savepoint', full_rollback), \
+			patch('frappe.model.workflow.print_workflow_log') as print_workflow_log:
+			bulk_workflow_approval(json.dumps([todo1.name, todo2.name, todo3.name]), 'ToDo', 'Approve')
+
+		self.assertEqual(get_workflow_state(todo1), 'Pending')
+		self.assertEqual(get_workflow_state(todo2), 'Rejected')
+		self.assertEqual(get_workflow_state(todo3), 'Approved')
+
+		failed_transactions = print_workflow_log.call_args_list[0][0][0]
+		successful_transactions = print_workflow_log.call_args_list[1][0][0]
+		self.assertSetEqual(set(failed_transactions), {todo1.name, todo2.name})
+		self.assertSetEqual(set(successful_transactions), {todo3.name})
+
+	def test_bulk_workflow_approval_same_state_after_transaction_rollback(self):
+		'''Test a rolled back transition to the same state is reported as failed'''
+		self.workflow.append('transitions', dict(
+			state = 'Pending', action='Review', next_state = 'Pending',
+			allowed='All', allow_self_approval= 1
+		))
+		self.workflow.save()
+
+		todo1, todo2, todo3 = create_new_todo(), create_new_todo(), create_new_todo()
+		# Review is not a valid action for an approved todo
+		apply_workflow(todo2, 'Approve')
+		frappe.db.commit()
+		todo1_modified = frappe.db.get_value('ToDo', todo1.name, 'modified')
+
+		def full_rollback(save_point):
+			frappe.db.rollback()
+			return False
+
+		with patch('frappe.model.workflow.rollback_to_savepoint', full_rollback), \
+			patch('frappe.model.workflow.print_workflow_log') as print_workflow_log:
+			bulk_workflow_approval(json.dumps([todo1.name, todo2.name, todo3.name]), 'ToDo', 'Review')
+
+		self.assertEqual(frappe.db.get_value('ToDo', todo1.name, 'modified'), todo1_modified)
+		self.assertEqual(get_workflow_state(todo1), 'Pending')
+		self.assertEqual(get_workflow_state(todo3), 'Pending')
+
+		failed_transactions = print_workflow_log.call_args_list[0][0][0]
+		successful_transactions = print_workflow_log.call_args_list[1][0][0]
+		self.assertSetEqual(set(failed_transactions), {todo1.name, todo2.name})
+		self.assertSetEqual(set(successful_transactions), {todo3.name})
+
 	def test_if_workflow_actions_were_processed(self):
 		frappe.db.sql('delete from `tabWorkflow Action`')
 		user = frappe.get_doc('User', 'test2@example.com')
@@ -162,5 +243,8 @@ def create_todo_workflow():
 
 	return workflow
 
+def get_workflow_state(todo):
+	return frappe.db.get_value('ToDo', todo.name, 'workflow_state')
+
 def create_new_todo():
 	return frappe.get_doc(dict(doctype='ToDo', description='workflow ' + random_string(10))).insert()
@@ -20,6 +20,11 @@ class Workflow(Document):
 		frappe.clear_cache(doctype=self.document_type)
 		frappe.cache().delete_key('workflow_' + self.name) # clear cache created in model/workflow.py
 
+	def on_trash(self):
+		frappe.clear_cache(doctype=self.document_type)
+		frappe.cache().delete_key('workflow_' + self.name)
+		self.clear_cache()
+
 	def create_custom_field_for_workflow_state(self):
 		frappe.clear_cache(doctype=self.document_type)
 		meta = frappe.get_meta(self.document_type)
@@ -10,7 +10,8 @@ from frappe.desk.form.utils import get_pdf_link
 from frappe.utils.verified_command import get_signed_params, verify_request
 from frappe import _
 from frappe.model.workflow import apply_workflow, get_workflow_name, has_approval_access, \
-	get_workflow_state_field, send_email_alert, get_workflow_field_value, is_transition_condition_satisfied
+	get_workflow_state_field, send_email_alert, get_workflow_field_value, is_transition_condition_satisfied, \
+	get_workflow_document_state_value
 from frappe.desk.notifications import clear_doctype_notifications
 from frappe.utils.user import get_users_with_role
 
@@ -302,16 +303,10 @@ def get_email_template(doc):
 	"""
 	workflow_name = get_workflow_name(doc.get('doctype'))
 	doc_state = get_doc_workflow_state(doc)
-	template_name = frappe.db.get_value('Workflow Document State', {
-		'parent': workflow_name,
-		'state': doc_state
-	}, 'next_action_email_template')
+	template_name = get_workflow_document_state_value(workflow_name, doc_state, 'next_action_email_template')
 
 	if not template_name: return
 	return frappe.get_doc('Email Template', template_name)
 
 def get_state_optional_field_value(workflow_name, state):
-	return frappe.get_cached_value('Workflow Document State', {
-		'parent': workflow_name,
-		'state': state
-	}, 'is_optional_state')
+	return get_workflow_document_state_value(workflow_name, state, 'is_optional_state')